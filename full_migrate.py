@@ -27,6 +27,11 @@ MQTT Configuration:
 - MQTT_USERNAME: MQTT authentication username
 - MQTT_PASSWORD: MQTT authentication password
 - MQTT_TOPIC: MQTT topic for reboot commands
+- MQTT_KEEPALIVE: Keepalive interval in seconds (optional, default 60)
+
+Scan Configuration (optional):
+- USE_SUBPROCESS_SCAN: Set to true to run the `tinytuya scan` CLI and read
+  SNAPSHOT_FILE instead of scanning in-process
 
 Logging Configuration:
 - LOG_LEVEL: Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
@@ -41,14 +46,24 @@ Note: This script requires appropriate permissions to read/write Home Assistant
 configuration files and communicate with the MQTT broker.
 """
 
+import atexit
 import logging
 import os
+import re
 import shutil
 import subprocess
-from pathlib import Path
-from typing import Optional
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path, PurePath, PureWindowsPath
+from typing import Dict, Iterable, Optional, Tuple
 
 import paho.mqtt.client as mqtt
+import tinytuya
+
+from migrate import LARGE_CONFIG_SIZE, migrate
 
 try:
     from dotenv import load_dotenv
@@ -59,10 +74,16 @@ except ImportError:
 if not load_dotenv():
     raise RuntimeError("Failed to load .env file")
 
+# Environment variable names containing any of these are treated as paths
+_PATH_RE = re.compile(r'path|file|dir', re.IGNORECASE)
+
+@lru_cache(maxsize=None)
 def get_env_var(var_name: str) -> str:
     """
     Retrieve and validate required environment variables.
 
+    Results are memoized, as the environment is not expected to change during a run.
+
     Args:
         var_name (str): Name of the environment variable to retrieve
 
@@ -77,26 +98,33 @@ def get_env_var(var_name: str) -> str:
         raise ValueError(f"Required environment variable '{var_name}' is not set")
     
     # Normalize path-like environment variables
-    if any(key in var_name.lower() for key in ['path', 'file', 'dir']):
+    if _PATH_RE.search(var_name):
         # Convert Windows backslashes to forward slashes and normalize path
-        value = os.path.normpath(value.replace('\\', '/'))
+        value = str(PurePath(PureWindowsPath(value).as_posix()))
     
     return value
 
-# Configure logging with explicit UTF-8 encoding
+# Configure logging to both the log file (explicit UTF-8 encoding) and the console
 logging.basicConfig(
-    filename=get_env_var('LOG_FILE'),
     level=getattr(logging, get_env_var('LOG_LEVEL')),
     format=get_env_var('LOG_FORMAT'),
-    encoding='utf-8'
+    handlers=[
+        logging.FileHandler(get_env_var('LOG_FILE'), encoding='utf-8'),
+        logging.StreamHandler(sys.stdout),
+    ]
 )
+log = logging.getLogger(__name__)
 
 # Define paths
 TINYTUYA_COMMAND = "tinytuya scan"
+# Lines of `tinytuya scan` output repeated at ERROR level when the scan fails
+SCAN_OUTPUT_TAIL_LINES = 50
 SNAPSHOT_FILE = get_env_var('SNAPSHOT_FILE')
 CORE_CONFIG_FILE = get_env_var('CORE_CONFIG_FILE')
 BACKUP_FILE = get_env_var('BACKUP_FILE')
 LOCAL_CORE_CONFIG_FILE = get_env_var('LOCAL_CORE_CONFIG_FILE')
+# Optional: run the tinytuya CLI in a subprocess instead of scanning in-process
+USE_SUBPROCESS_SCAN = os.getenv('USE_SUBPROCESS_SCAN', '').lower() in ('1', 'true', 'yes')
 
 # MQTT configuration
 MQTT_BROKER = get_env_var('MQTT_BROKER')
@@ -104,124 +132,241 @@ MQTT_PORT = int(get_env_var('MQTT_PORT'))
 MQTT_USERNAME = get_env_var('MQTT_USERNAME')
 MQTT_PASSWORD = get_env_var('MQTT_PASSWORD')
 MQTT_TOPIC = get_env_var('MQTT_TOPIC')
+# Optional: keepalive interval in seconds for the MQTT connection
+MQTT_KEEPALIVE = int(os.getenv('MQTT_KEEPALIVE', '60'))
+# Seconds to wait for the broker to accept the connection or acknowledge a publish
+MQTT_TIMEOUT = 5
 
-def log(message: str, level: str = 'info') -> None:
+_mqtt_client: Optional[mqtt.Client] = None
+_mqtt_connected = threading.Event()
+_mqtt_last_error: Optional[str] = None
+
+def _copy_batch(pairs: Iterable[Tuple[str, str]]) -> None:
     """
-    Log messages to both console and log file.
+    Copy a batch of independent files concurrently.
 
     Args:
-        message (str): Message to be logged
-        level (str, optional): Log level ('info' or 'error'). Defaults to 'info'.
+        pairs (Iterable[Tuple[str, str]]): (source, destination) paths to copy
+
+    Raises:
+        OSError: If any of the copies fails; all copies are waited on first.
 
     Note:
-        Messages are always printed to console regardless of log level.
-        For file logging, messages are logged at the specified level.
+        Each copy uses shutil.copyfile, which streams bytes in the kernel
+        (sendfile on Linux), so running them side by side lets the IO overlap.
+    """
+    pairs = list(pairs)
+    with ThreadPoolExecutor(max_workers=len(pairs)) as pool:
+        futures = [pool.submit(shutil.copyfile, src, dst) for src, dst in pairs]
+    for future in futures:
+        future.result()
+
+def _record_mqtt_error(cause: str) -> None:
+    """
+    Log an MQTT connection error once and keep its cause for the publish step's report.
+
+    The background loop retries failed connections, so repeats of the same
+    error are not logged again.
+    """
+    global _mqtt_last_error
+    if cause != _mqtt_last_error:
+        log.error(f"Error connecting to MQTT broker {MQTT_BROKER}:{MQTT_PORT}: {cause}")
+    _mqtt_last_error = cause
+
+def _start_mqtt() -> mqtt.Client:
     """
-    print(message)
-    if level == 'info':
-        logging.info(message)
-    elif level == 'error':
-        logging.error(message)
+    Start connecting to the MQTT broker in the background, creating the client on first use.
+
+    The client is cached in a module global and runs its network loop in a
+    background thread, so the TCP/MQTT handshake overlaps with the rest of the
+    migration and repeated calls reuse the same connection.
+
+    Returns:
+        mqtt.Client: MQTT client, which may still be connecting
+    """
+    global _mqtt_client
+    if _mqtt_client is not None:
+        return _mqtt_client
+
+    def on_connect(client, userdata, flags, rc, properties=None):
+        if rc == 0:
+            log.info(f"Connected to MQTT broker {MQTT_BROKER}:{MQTT_PORT}.")
+            _mqtt_connected.set()
+        else:
+            _record_mqtt_error(f"broker refused connection: {rc}")
+
+    def on_connect_fail(client, userdata):
+        # paho calls this from inside its `except OSError` block without passing
+        # the exception, so recover the socket/DNS error from the active exception
+        _record_mqtt_error(str(sys.exc_info()[1]))
+
+    def on_disconnect(client, userdata, *args):
+        # Arguments differ between paho callback API versions; only the state matters
+        _mqtt_connected.clear()
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_connect_fail = on_connect_fail
+    client.on_disconnect = on_disconnect
+
+    # Configure authentication if credentials are provided
+    if MQTT_USERNAME and MQTT_PASSWORD:
+        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+
+    client.connect_async(MQTT_BROKER, MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+    client.loop_start()
+
+    def close() -> None:
+        client.disconnect()
+        client.loop_stop()
+
+    atexit.register(close)
+    _mqtt_client = client
+    return client
+
+def _get_mqtt() -> mqtt.Client:
+    """
+    Return a connected MQTT client, waiting for the background connection if needed.
+
+    Returns:
+        mqtt.Client: Connected MQTT client
+
+    Raises:
+        TimeoutError: If the broker does not accept the connection in time
+    """
+    client = _start_mqtt()
+    if not _mqtt_connected.wait(MQTT_TIMEOUT):
+        message = f"Timed out connecting to MQTT broker {MQTT_BROKER}:{MQTT_PORT}"
+        if _mqtt_last_error:
+            message += f": {_mqtt_last_error}"
+        raise TimeoutError(message)
+    return client
+
+# Start the MQTT handshake now so it overlaps with the scan and file work below
+try:
+    _start_mqtt()
+except Exception as e:
+    # Non-fatal here; the publish step reports the failure
+    log.error(f"Error starting MQTT connection: {e}")
 
 # TODO: Add retry mechanism for tinytuya scan in case of temporary network issues
 # TODO: Add validation of scan results before proceeding
 
-# Step 1: Run tinytuya scan to discover local Tuya devices
+# Step 1: Scan for local Tuya devices. By default tinytuya is called in-process
+# and the discovered IPs are handed straight to migrate(); set
+# USE_SUBPROCESS_SCAN to run the `tinytuya scan` CLI and read its snapshot.json.
+snapshot_ips: Optional[Dict[str, str]] = None
+
+# Read core.config_entries in the background while the scan runs, so the
+# backup step below usually only has to write it out. The file's stat is
+# recorded first so a change made by Home Assistant during the scan is detected.
+config_reader = ThreadPoolExecutor(max_workers=1)
+config_future = None
+config_stat = None
 try:
-    log("Running tinytuya scan...")
-    # Use shell=True to handle command with arguments, capture both stdout/stderr for logging
-    result = subprocess.run(TINYTUYA_COMMAND, shell=True, check=True, capture_output=True, text=True)
-    
-    # Log all output to maintain complete audit trail
-    if result.stdout:
-        log(result.stdout)
-    if result.stderr:  # stderr may contain important warnings even on success
-        log(result.stderr)
-    log("tinytuya scan completed successfully.")
-except subprocess.CalledProcessError as e:
-    # Comprehensive error logging for debugging
-    log(f"Error running tinytuya scan: {e}", 'error')
-    if e.output:
-        log(e.output, 'error')
-    if e.stderr:
-        log(e.stderr, 'error')
-    exit(1)  # Exit on scan failure as continuing would be pointless
+    config_stat = os.stat(CORE_CONFIG_FILE)
+    if config_stat.st_size <= LARGE_CONFIG_SIZE:
+        config_future = config_reader.submit(Path(CORE_CONFIG_FILE).read_bytes)
+except OSError:
+    pass  # Reported by the backup step below
+
+if USE_SUBPROCESS_SCAN:
+    try:
+        log.info("Running tinytuya scan...")
+        # Use shell=True to handle command with arguments; stderr is merged into
+        # stdout and logged line by line as the scan progresses. The tail is kept
+        # so it can be reported at ERROR level if the scan fails.
+        output_tail = deque(maxlen=SCAN_OUTPUT_TAIL_LINES)
+        with subprocess.Popen(TINYTUYA_COMMAND, shell=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, text=True, bufsize=1) as proc:
+            for line in proc.stdout:
+                line = line.rstrip()
+                log.info(line)
+                output_tail.append(line)
+            returncode = proc.wait()
+        if returncode != 0:
+            log.error(f"Error running tinytuya scan: '{TINYTUYA_COMMAND}' exited with status {returncode}")
+            if output_tail:
+                log.error(f"Last {len(output_tail)} lines of tinytuya scan output:\n" + "\n".join(output_tail))
+            exit(1)  # Exit on scan failure as continuing would be pointless
+        log.info("tinytuya scan completed successfully.")
+    except Exception as e:
+        log.error(f"Error running tinytuya scan: {e}", exc_info=True)
+        exit(1)  # Exit on scan failure as continuing would be pointless
+else:
+    try:
+        log.info("Running tinytuya scan...")
+        # Only IPs are needed, so skip polling device status
+        devices = tinytuya.deviceScan(verbose=False, color=False, poll=False, byID=True)
+        snapshot_ips = {
+            device_id: device['ip']
+            for device_id, device in devices.items()
+            if device_id and device.get('ip')
+        }
+        log.info(f"tinytuya scan completed successfully. Found {len(snapshot_ips)} devices.")
+    except Exception as e:
+        log.error(f"Error running tinytuya scan: {e}", exc_info=True)
+        exit(1)  # Exit on scan failure as continuing would be pointless
 
 # TODO: Add backup file rotation to keep multiple versions
 # TODO: Add backup verification step to ensure backup integrity
 
-# Step 2: Backup core.config_entries before modifications
-try:
-    log("Backing up core.config_entries...")
-    with open(CORE_CONFIG_FILE, 'r', encoding='utf-8') as src, \
-         open(BACKUP_FILE, 'w', encoding='utf-8') as dst:
-        dst.write(src.read())
-    log(f"Backup created at {BACKUP_FILE}.")
-except Exception as e:
-    log(f"Error creating backup: {e}", 'error')
-    exit(1)  # Exit if backup fails to prevent potential data loss
-
-# Step 3: Copy core.config_entries to local working directory
+# Steps 2 and 3: Backup core.config_entries before modifications and copy it
+# to the local working directory. Both read the same source, so typical files
+# are read once (in the background during the scan) and written to both
+# destinations; very large files are copied as a single batch instead of being
+# held in memory.
 try:
-    log("Copying core.config_entries to local directory for processing...")
-    with open(CORE_CONFIG_FILE, 'r', encoding='utf-8') as src, \
-         open(LOCAL_CORE_CONFIG_FILE, 'w', encoding='utf-8') as dst:
-        dst.write(src.read())
-    log(f"File copied to {LOCAL_CORE_CONFIG_FILE}.")
+    log.info("Backing up core.config_entries...")
+    log.info("Copying core.config_entries to local directory for processing...")
+    if config_future is not None:
+        config_bytes = config_future.result()
+        # Re-read if the file changed since the pre-scan read, so entries written
+        # during the scan are neither missing from the backup nor overwritten
+        current_stat = os.stat(CORE_CONFIG_FILE)
+        if (current_stat.st_mtime_ns, current_stat.st_size) != (config_stat.st_mtime_ns, config_stat.st_size):
+            log.info("core.config_entries changed during the scan, re-reading it...")
+            config_bytes = Path(CORE_CONFIG_FILE).read_bytes()
+        Path(BACKUP_FILE).write_bytes(config_bytes)
+        Path(LOCAL_CORE_CONFIG_FILE).write_bytes(config_bytes)
+    else:
+        _copy_batch([
+            (CORE_CONFIG_FILE, BACKUP_FILE),
+            (CORE_CONFIG_FILE, LOCAL_CORE_CONFIG_FILE),
+        ])
+    log.info(f"Backup created at {BACKUP_FILE}.")
+    log.info(f"File copied to {LOCAL_CORE_CONFIG_FILE}.")
 except Exception as e:
-    log(f"Error copying file: {e}", 'error')
-    exit(1)  # Exit if local copy fails as we can't proceed with migration
-
-# Step 4: Run migrate.py
-try:
-    log("Running migrate.py...")
-    # Capture output from migrate.py
-    result = subprocess.run(["python", "migrate.py"], check=True, capture_output=True, text=True)
-    if result.stdout:
-        log(result.stdout)
-    if result.stderr:
-        log(result.stderr)
-    log("migrate.py completed successfully.")
-except subprocess.CalledProcessError as e:
-    log(f"Error running migrate.py: {e}", 'error')
-    if e.output:
-        log(e.output, 'error')
-    if e.stderr:
-        log(e.stderr, 'error')
-    exit(1)
+    log.error(f"Error creating backup or local copy: {e}", exc_info=True)
+    exit(1)  # Exit if either copy fails to prevent potential data loss
+finally:
+    config_reader.shutdown()
 
-# Step 5: Copy updated core.config_entries back
+# Step 4: Run the migration in-process, reading the local copy and writing the
+# updated entries straight back to the original location
 try:
-    log("Copying updated core.config_entries back to original location...")
-    with open(LOCAL_CORE_CONFIG_FILE, 'r', encoding='utf-8') as src, \
-         open(CORE_CONFIG_FILE, 'w', encoding='utf-8') as dst:
-        dst.write(src.read())
-    log("File restored successfully.")
+    log.info("Running migrate.py...")
+    for entry in migrate(SNAPSHOT_FILE, LOCAL_CORE_CONFIG_FILE, CORE_CONFIG_FILE, snapshot_ips):
+        log.info(entry)
+    log.info("migrate.py completed successfully.")
 except Exception as e:
-    log(f"Error restoring updated file: {e}", 'error')
+    log.error(f"Error running migrate.py: {e}", exc_info=True)
     exit(1)
 
-log("Process completed successfully!")
+log.info("Process completed successfully!")
 
 # TODO: Add MQTT connection retry logic
-# TODO: Add confirmation of reboot command receipt
-# TODO: Add timeout handling for MQTT operations
 
 # Publish MQTT message to request a Home Assistant reboot
 try:
-    log("Publishing MQTT reboot message...")
-    client = mqtt.Client()
-    
-    # Configure authentication if credentials are provided
-    if MQTT_USERNAME and MQTT_PASSWORD:
-        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    
-    # Connect with 60 second keepalive, publish message, then cleanup
-    client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    client.publish(MQTT_TOPIC, "reboot")
-    client.disconnect()
-    log(f"MQTT reboot message published to topic '{MQTT_TOPIC}'.")
+    log.info("Publishing MQTT reboot message...")
+    client = _get_mqtt()
+    # QoS 1 so the broker acknowledges receipt of the reboot command
+    info = client.publish(MQTT_TOPIC, "reboot", qos=1)
+    info.wait_for_publish(timeout=MQTT_TIMEOUT)
+    if not info.is_published():
+        raise TimeoutError("Broker did not acknowledge the reboot message")
+    log.info(f"MQTT reboot message published to topic '{MQTT_TOPIC}'.")
 except Exception as e:
     # Non-fatal error as the migration has already completed
-    log(f"Error publishing MQTT message: {e}", 'error')
-
+    log.error(f"Error publishing MQTT message: {e}")
@@ -1,72 +1,223 @@
-import json
+import logging
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Tuple
 
-# Load snapshot.json data
 try:
-    with open('snapshot.json', 'r') as snapshot_file:
-        snapshot_data = json.load(snapshot_file)
-    print("snapshot.json loaded successfully.")
-except Exception as e:
-    print(f"Error loading snapshot.json: {e}")
-
-# Extract IP addresses and device IDs from snapshot.json
-snapshot_ips = {}
-for device in snapshot_data.get('devices', []):
-    device_id = device.get('id')
-    device_ip = device.get('ip')
-    if device_id and device_ip:
-        snapshot_ips[device_id] = device_ip
+    import orjson
+except ImportError:  # orjson is optional; fall back to the standard library
+    orjson = None
+    import json
+
+try:
+    import ijson
+except ImportError:  # ijson is optional; large files are then loaded in full
+    ijson = None
+
+# Config files larger than this are not buffered whole unless necessary: they
+# are streamed here to find pending updates, and copied rather than read into
+# memory by full_migrate.py
+LARGE_CONFIG_SIZE = 8 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def _loads(raw: bytes) -> Any:
+    """Parse JSON bytes, using orjson when it is available."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _dumps(data: Any) -> bytes:
+    """Serialize data to indented JSON bytes, using orjson when it is available."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """
+    Write data to path via a temporary file and os.replace.
+
+    A crash mid-write leaves the original file intact instead of a truncated
+    one. The existing file's permissions are carried over to the replacement.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _find_updates(config_path: str, snapshot_ips: Dict[str, str]) -> List[Tuple[int, str]]:
+    """
+    Stream core.config_entries with ijson and collect the entries whose IP differs.
+
+    Only one entry is held in memory at a time, so a run with nothing to change
+    never materializes the full document. When there are updates the file still
+    has to be loaded in full to rewrite it, but the returned matches are applied
+    directly instead of being searched for again.
+
+    Returns:
+        List[Tuple[int, str]]: (index into data.entries, new IP) for each entry to update
+    """
+    updates = []
+    with open(config_path, 'rb') as config_file:
+        for index, entry in enumerate(ijson.items(config_file, 'data.entries.item')):
+            device_data = entry.get("data")
+            if not device_data:
+                continue
+            new_ip = snapshot_ips.get(device_data.get("device_id"))
+            if new_ip is not None and device_data.get("host", "N/A") != new_ip:
+                updates.append((index, new_ip))
+    return updates
+
+
+def load_snapshot_ips(snapshot_path: str = 'snapshot.json') -> Dict[str, str]:
+    """
+    Load a tinytuya snapshot.json file and map each device ID to its IP.
+
+    Args:
+        snapshot_path (str, optional): Path to the tinytuya snapshot.json file
+
+    Returns:
+        Dict[str, str]: Device ID to IP address
+
+    Raises:
+        Exception: If the snapshot file cannot be loaded
+    """
+    # Load snapshot.json data
+    try:
+        with open(snapshot_path, 'rb') as snapshot_file:
+            snapshot_data = _loads(snapshot_file.read())
+        logger.info("snapshot.json loaded successfully.")
+    except Exception as e:
+        logger.error(f"Error loading snapshot.json: {e}")
+        raise
+
+    # Extract IP addresses and device IDs from snapshot.json
+    devices = snapshot_data.get('devices', ())
+    snapshot_ips = {d['id']: d['ip'] for d in devices if d.get('id') and d.get('ip')}
+    if logger.isEnabledFor(logging.DEBUG):
+        for device in devices:
+            if not (device.get('id') and device.get('ip')):
+                logger.debug(f"Skipping device with missing ID or IP: {device}")
+
+    logger.info(f"Extracted {len(snapshot_ips)} devices from snapshot.json.")
+    return snapshot_ips
+
+
+def migrate(
+    snapshot_path: str = 'snapshot.json',
+    config_path: str = 'core.config_entries',
+    output_path: Optional[str] = None,
+    snapshot_ips: Optional[Dict[str, str]] = None,
+) -> List[str]:
+    """
+    Update Tuya device IPs in a core.config_entries file from a tinytuya snapshot.
+
+    Entries whose IP already matches the snapshot are left alone, and output_path
+    is only written when at least one IP actually changes.
+
+    Args:
+        snapshot_path (str, optional): Path to the tinytuya snapshot.json file
+        config_path (str, optional): Path to the core.config_entries file to read
+        output_path (str, optional): Path to write the updated entries to.
+            Defaults to config_path.
+        snapshot_ips (Dict[str, str], optional): Device ID to IP mapping from an
+            in-process scan. When given, snapshot_path is not read.
+
+    Returns:
+        List[str]: One log entry per device whose IP was updated
+
+    Raises:
+        Exception: If either file cannot be loaded or the update cannot be written
+    """
+    if output_path is None:
+        output_path = config_path
+
+    if snapshot_ips is None:
+        snapshot_ips = load_snapshot_ips(snapshot_path)
+
+    # Large files: find pending updates with a streaming pass and skip the full
+    # load entirely when there is nothing to change
+    pending_updates = None
+    if ijson is not None and os.path.getsize(config_path) > LARGE_CONFIG_SIZE:
+        pending_updates = _find_updates(config_path, snapshot_ips)
+        if not pending_updates:
+            logger.info("No device IPs changed. No updates were made.")
+            return []
+
+    # Load core.config_entries data
+    try:
+        with open(config_path, 'rb') as config_file:
+            config_entries = _loads(config_file.read())
+        logger.info("core.config_entries loaded successfully.")
+    except Exception as e:
+        logger.error(f"Error loading core.config_entries: {e}")
+        raise
+
+    # Check the top-level structure of core.config_entries
+    logger.info(f"Top-level keys in core.config_entries: {list(config_entries.keys())}")
+
+    log_entries = []
+
+    # Iterate over entries in core.config_entries to find matching device_id
+    entries = config_entries.get("data", {}).get("entries", [])
+    logger.info(f"Found {len(entries)} entries in core.config_entries.")
+
+    if pending_updates is not None:
+        # The streaming pass already located the entries to change
+        matches = [(entries[index], new_ip) for index, new_ip in pending_updates]
     else:
-        print(f"Skipping device with missing ID or IP: {device}")
+        # Index entries by device_id in one pass, so matching only runs over
+        # snapshot devices rather than every (mostly non-Tuya) entry
+        entries_by_id: Dict[str, List[Dict[str, Any]]] = {}
+        for entry in entries:
+            device_id = (entry.get("data") or {}).get("device_id")
+            if device_id:
+                entries_by_id.setdefault(device_id, []).append(entry)
 
-print(f"Extracted {len(snapshot_ips)} devices from snapshot.json.")
+        matches = [
+            (entry, new_ip)
+            for device_id, new_ip in snapshot_ips.items()
+            for entry in entries_by_id.get(device_id, ())
+            # Assuming 'host' holds the IP address
+            if entry["data"].get("host", "N/A") != new_ip
+        ]
 
-# Load core.config_entries data
-try:
-    with open('core.config_entries', 'r') as config_file:
-        config_entries = json.load(config_file)
-    print("core.config_entries loaded successfully.")
-except Exception as e:
-    print(f"Error loading core.config_entries: {e}")
-
-# Check the top-level structure of core.config_entries
-print(f"Top-level keys in core.config_entries: {list(config_entries.keys())}")
-
-# Initialize logging variables
-updated = False
-log_entries = []
-
-# Iterate over entries in core.config_entries to find matching device_id
-entries = config_entries.get("data", {}).get("entries", [])
-print(f"Found {len(entries)} entries in core.config_entries.")
-
-for i, entry in enumerate(entries):
-    # Access the device_id within the nested 'data' object
-    device_data = entry.get("data", {})
-    device_id = device_data.get("device_id")
-    title = entry.get("title")
-    current_ip = device_data.get("host", "N/A")  # Assuming 'host' holds the IP address
-    
-    print(f"\nInspecting entry {i + 1}/{len(entries)}:")
-    print(f"device_id: {device_id}, current IP: {current_ip}")
-    
-    if device_id in snapshot_ips:
-        new_ip = snapshot_ips[device_id]
-        print(f"Match found for {title} {device_id}. Updating IP from {current_ip} to {new_ip}.")
+    for entry, new_ip in matches:
+        device_data = entry["data"]
+        current_ip = device_data.get("host", "N/A")
         device_data["host"] = new_ip  # Replace IP address in the nested data dictionary
-        log_entries.append(f"Updated {title} {device_id}: {current_ip} -> {new_ip}")
-        updated = True
+        log_entries.append(f"Updated {entry.get('title')} {device_data.get('device_id')}: {current_ip} -> {new_ip}")
+    updated = bool(matches)
+
+    # Write updated core.config_entries data back to the file if any changes were made
+    if updated:
+        try:
+            _write_atomic(output_path, _dumps(config_entries))
+            logger.info("IP addresses updated successfully.")
+        except Exception as e:
+            logger.error(f"Error writing updated core.config_entries: {e}")
+            raise
     else:
-        print(f"No match found for device_id {device_id}.")
+        logger.info("No device IPs changed. No updates were made.")
 
-# Write updated core.config_entries data back to the file if any changes were made
-if updated:
-    try:
-        with open('core.config_entries', 'w') as config_file:
-            json.dump(config_entries, config_file, indent=4)
-        print("IP addresses updated successfully.")
-        print("Log of updates:")
-        print("\n".join(log_entries))
-    except Exception as e:
-        print(f"Error writing updated core.config_entries: {e}")
-else:
-    print("No matching device IDs found. No updates were made.")
\ No newline at end of file
+    return log_entries
+
+
+if __name__ == '__main__':
+    # Standalone runs report to the console; set LOG_LEVEL=DEBUG for skipped devices
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(message)s')
+    for log_entry in migrate():
+        logger.info(log_entry)